@@ -17,14 +17,41 @@ Usage:
 """
 import logging
 import os
+import re
+import threading
 import time
 from pathlib import Path
+from typing import Iterator
 
 from pyicloud import PyiCloudService
+from pyicloud.exceptions import PyiCloudAPIResponseException
 from pyicloud.services.photos import PhotoAlbum, PhotoAsset
 
 log = logging.getLogger(__name__)
 
+# pyicloud saves its session file and cookies after every request, which isn't
+# safe to do from several threads at once. Anything that sends a request on the
+# shared session (starting a download in a worker, or fetching the next page of
+# an album in the main thread) has to hold this lock. The photos themselves
+# still stream in parallel.
+_SESSION_LOCK = threading.Lock()
+
+_MONTHS = {
+    'january': '01',
+    'february': '02',
+    'march': '03',
+    'april': '04',
+    'may': '05',
+    'june': '06',
+    'july': '07',
+    'august': '08',
+    'september': '09',
+    'october': '10',
+    'november': '11',
+    'december': '12',
+}
+_MONTHS.update({month[:3]: number for month, number in _MONTHS.items()})
+
 
 def login(username: str = '', password: str = '') -> PyiCloudService:
     """
@@ -90,9 +117,9 @@ def login(username: str = '', password: str = '') -> PyiCloudService:
     return api
 
 
-def heic_to_png(heic_file: str | Path, delete_old: bool = False) -> str:
+def heic_to_jpeg(heic_file: str | Path, delete_old: bool = False) -> str:
     """
-    Convert HEIC format image to PNG. Optionally, delete the original HEIC file.
+    Convert HEIC format image to JPEG. Optionally, delete the original HEIC file.
 
     Parameters:
         heic_file (Path): Path to the HEIC image file.
@@ -100,37 +127,141 @@ def heic_to_png(heic_file: str | Path, delete_old: bool = False) -> str:
             Defaults to False.
 
     Returns:
-        str: Path to the converted PNG image file.
+        str: Path to the converted JPEG image file.
 
     Dependencies:
-        pyheif: Python library for working with HEIC images.
+        pillow_heif: HEIF/HEIC plugin for Pillow.
         PIL (Pillow): Python Imaging Library for image processing.
     """
-    import pyheif
     from PIL import Image
+    from pillow_heif import register_heif_opener
 
     heic_file = Path(heic_file)
 
-    # Load HEIC data with pyheif and use it to create a PIL image object.
-    log.debug('Converting %s to PNG...' % heic_file)
-    heif = pyheif.read(heic_file.as_posix())
-    img = Image.frombytes(
-        heif.mode,
-        heif.size,
-        heif.data,
-        'raw',
-        heif.mode,
-        heif.stride,
-    )
-
-    png_file = heic_file.with_suffix('.png')
-    img.save(png_file.as_posix())
+    # Let PIL open the HEIC file directly. This decodes straight into the PIL
+    # image instead of copying the pixel data through a Python bytes object.
+    register_heif_opener()
+    log.debug('Converting %s to JPEG...' % heic_file)
+    jpeg_file = heic_file.with_suffix('.jpg')
+    with Image.open(heic_file.as_posix()) as img:
+        # JPEG is much cheaper to encode than PNG and a fraction of the size to
+        # upload, and it's plenty good enough for OCR.
+        if img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+        img.save(jpeg_file.as_posix(), 'JPEG', quality=92, optimize=False)
     if delete_old:
         log.debug('Deleting %s...' % heic_file)
         heic_file.unlink()
 
-    log.info('Converted %s to PNG at %s.' % (heic_file.name, png_file))
-    return png_file.as_posix()
+    log.info('Converted %s to JPEG at %s.' % (heic_file.name, jpeg_file))
+    return jpeg_file.as_posix()
+
+
+def iter_album(album: PhotoAlbum) -> Iterator[PhotoAsset]:
+    """
+    Iterate through the photos in an album, one page of results at a time.
+
+    Parameters:
+        album (PhotoAlbum): PhotoAlbum object containing the album to list.
+
+    Returns:
+        iterator of PhotoAsset: Photos in the album.
+
+    pyicloud fetches each page as we get to it, so every step through the album
+    can send a request on the shared session. Take the lock for each step, but
+    not while the caller works on the photo it gets back.
+    """
+    photos = iter(album)
+    while True:
+        with _SESSION_LOCK:
+            photo = next(photos, None)
+        if photo is None:
+            return
+        yield photo
+
+
+def download_photo(
+    photo: PhotoAsset,
+    img_file: str | Path,
+    max_retries: int = 3,
+    retry_delay: float = 60.0,
+) -> bool:
+    """
+    Download a single photo from iCloud and save it to the specified file.
+
+    Parameters:
+        photo (PhotoAsset): PhotoAsset object for the photo to download.
+        img_file (str or Path): File path to save the downloaded photo to.
+        max_retries (int): Retries to attempt after failed request.
+        retry_delay (float): Seconds to wait between retries.
+
+    Returns:
+        bool: Whether the photo was downloaded.
+
+    The filesystem timestamps are adjusted to reflect the "created on" property
+    from iCloud, providing an additional way to sort the photos.
+    """
+    img_file = Path(img_file)
+
+    for attempt in range(max_retries + 1):
+        try:
+            with _SESSION_LOCK:
+                download = photo.download()
+            break
+        except PyiCloudAPIResponseException:
+            log.error('Failed with code 503 (%s).' % photo.filename)
+            if attempt == max_retries:
+                return False
+            log.info(
+                'Retrying in %d seconds (%d/%d)...'
+                % (retry_delay, attempt + 1, max_retries)
+            )
+            time.sleep(retry_delay)
+
+    # Buffer the download so we don't have to keep the whole thing in RAM. The
+    # chunks are already big, so skip Python's file buffering and hand them
+    # straight to the OS. If we know how big the photo is, reserve the space
+    # up front so the file doesn't have to keep growing as we go.
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0)
+    fd = os.open(img_file, flags, 0o644)
+    try:
+        size = int(download.headers.get('Content-Length', 0))
+        if size and hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(fd, 0, size)
+
+        written = 0
+        for chunk in download.iter_content(chunk_size=4 * 1024 * 1024):
+            view = memoryview(chunk)
+            while view:
+                n = os.write(fd, view)
+                view = view[n:]
+                written += n
+
+        # Don't leave any of the reserved space hanging off the end.
+        if written != size:
+            os.ftruncate(fd, written)
+    except BaseException:
+        # If the download breaks off partway, get rid of what we have so far.
+        # Otherwise it'd look just like a finished photo (especially with the
+        # space reserved) and get skipped next time.
+        os.close(fd)
+        img_file.unlink(missing_ok=True)
+        raise
+    os.close(fd)
+
+    # Azure can't work with .HEIC so we'll need to convert before we do OCR.
+    # TODO: This has been moved to vision.py for case-by-case handling.
+    # Keeping the files in .HEIC format means they take up less space.
+    # It does make them slower to process, though, especially if we need to
+    # do it more than once.
+    # if img_file.suffix.lower() == '.heic':
+    #    img_file = Path(heic_to_jpeg(img_file, delete_old=True))
+
+    # Overwrite filesystem timestamp with iCloud's "created on" property,
+    # just as another way to help sort them if necessary.
+    timestamp = time.mktime(photo.created.timetuple())
+    os.utime(img_file, (timestamp, timestamp))
+    return True
 
 
 def download_album(
@@ -138,6 +269,7 @@ def download_album(
     album: PhotoAlbum,
     max_retries: int = 3,
     retry_delay: float = 60.0,
+    max_workers: int = 4,
 ):
     """
     Download photos from an album and save them to the specified path.
@@ -147,81 +279,116 @@ def download_album(
         album (PhotoAlbum): PhotoAlbum object containing the album to download.
         max_retries (int): Retries to attempt after failed request.
         retry_delay (float): Seconds to wait between retries.
+        max_workers (int): Number of photos to download at once.
 
     This function iterates through the photos in the specified album and
     downloads them to the provided path. It checks whether each photo has
-    already been downloaded based on the filename and skips those that have. If
-    a photo is in HEIC format, it automatically converts it to PNG.
+    already been downloaded based on the filename and skips those that have.
 
     The downloaded photos will be named with a timestamp and the original
-    filename to help sort them by the order they were taken. The filesystem
-    timestamps are also adjusted to reflect the "created on" property from
-    iCloud, providing an additional way to sort the photos.
+    filename to help sort them by the order they were taken. The downloads
+    themselves are spread across a small pool of worker threads, since most of
+    the time spent on each photo is waiting on iCloud rather than doing work.
     """
-    from pyicloud.exceptions import PyiCloudAPIResponseException
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    from requests.adapters import HTTPAdapter
 
     download_path = Path(download_path)
     count = len(album)
     dl_count = 0
+    fail_count = 0
+
+    # Give the shared session one pooled connection per worker so that each
+    # thread can keep its connection to iCloud open between photos.
+    adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+    album.service.session.mount('https://', adapter)
 
     log.info('Downloading %d photos from %s...' % (count, album.name))
-    for i, photo in enumerate(album):
-        # Add the created-on date to the filename in order to help us sort
-        # images in the order they were taken.
-        timestamp = photo.created.strftime('%Y-%m-%d_%H-%M-%S')
-        img_file = download_path / f"{timestamp}_{photo.filename}"
-
-        # Skip the photo if it's already been downloaded. Remember, we would
-        # have changed the filename during processing!
-        if img_file.exists() or img_file.with_suffix('.png').exists():
-            log.warn(
-                'Skipping %s from %s (%d/%d), image already downloaded.'
-                % (photo.filename, album.name, i + 1, count)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for i, photo in enumerate(iter_album(album)):
+            # Add the created-on date to the filename in order to help us sort
+            # images in the order they were taken.
+            timestamp = photo.created.strftime('%Y-%m-%d_%H-%M-%S')
+            img_file = download_path / f"{timestamp}_{photo.filename}"
+
+            # Skip the photo if it's already been downloaded. Remember, we would
+            # have changed the filename during processing!
+            if (
+                img_file.exists()
+                or img_file.with_suffix('.jpg').exists()
+                or img_file.with_suffix('.png').exists()
+            ):
+                log.warn(
+                    'Skipping %s from %s (%d/%d), image already downloaded.'
+                    % (photo.filename, album.name, i + 1, count)
+                )
+                continue
+
+            future = executor.submit(
+                download_photo, photo, img_file, max_retries, retry_delay
             )
-            continue
+            futures[future] = (i, photo)
 
-        log.info('%s from %s (%d/%d)' % (photo.filename, album.name, i + 1, count))
-        attempt = 0
-        while attempt == 0 or attempt < max_retries:
-            try:
-                download = photo.download()
-                break
-            except PyiCloudAPIResponseException:
-                log.error('Failed with code 503.')
-                if attempt < max_retries:
-                    log.info(
-                        'Retrying in %d seconds (%d/%d)...'
-                        % (retry_delay, attempt + 1, max_retries)
+        try:
+            for future in as_completed(futures):
+                i, photo = futures[future]
+                try:
+                    downloaded = future.result()
+                except Exception as e:
+                    # Just move on to the next one. Anything that didn't make it
+                    # will be picked up next time.
+                    log.error(
+                        'Failed to download %s from %s (%d/%d): %s'
+                        % (photo.filename, album.name, i + 1, count, e)
                     )
-                    attempt += 1
-                    time.sleep(retry_delay)
+                    downloaded = False
+                if not downloaded:
+                    fail_count += 1
+                    continue
+                dl_count += 1
+                log.info(
+                    '%s from %s (%d/%d)' % (photo.filename, album.name, i + 1, count)
+                )
+
+        except BaseException:
+            # Don't keep downloading the rest of the album in the background if
+            # we're stopping.
+            executor.shutdown(cancel_futures=True)
+            raise
+
+    log.info(
+        'Done! Got %d of %d photos from %s (%d failed).'
+        % (dl_count, count, album.name, fail_count)
+    )
 
-        # Buffer the download so we don't have to keep the whole thing in RAM.
-        with img_file.open('wb') as f:
-            for chunk in download.iter_content(chunk_size=1024 * 1024):
-                if chunk:
-                    f.write(chunk)
-        dl_count += 1
 
-        # Azure can't work with .HEIC so we'll need to convert before we do OCR.
-        # TODO: This has been moved to vision.py for case-by-case handling.
-        # Keeping the files in .HEIC format means they take up less space.
-        # It does make them slower to process, though, especially if we need to
-        # do it more than once.
-        # if img_file.suffix.lower() == '.heic':
-        #    img_file = Path(heic_to_png(img_file, delete_old=True))
+def get_album_folder(album: str) -> str:
+    """
+    Get the name of the folder to download an album into.
 
-        # Overwrite filesystem timestamp with iCloud's "created on" property,
-        # just as another way to help sort them if necessary.
-        timestamp = time.mktime(photo.created.timetuple())
-        os.utime(img_file, (timestamp, timestamp))
+    Parameters:
+        album (str): Album title.
+
+    Returns:
+        str: "YYYY-MM" if the title is a month/year combo, otherwise the title.
+    """
+    # Most of our albums are titled like "March 2023", so try matching that
+    # directly before falling back on dateutil for anything fancier.
+    match = re.fullmatch(r'([a-z]+)\s+(\d{4})', album.strip().lower())
+    if match and match.group(1) in _MONTHS:
+        return f"{match.group(2)}-{_MONTHS[match.group(1)]}"
+
+    from dateutil.parser import parse
 
-    log.info('Done! Got %d of %d photos from %s.' % (dl_count, count, album.name))
+    try:
+        return parse(album).strftime('%Y-%m')
+    except:
+        return album
 
 
 if __name__ == '__main__':
     import argparse
-    from dateutil.parser import parse
     from dotenv import load_dotenv
 
     logging.basicConfig(
@@ -238,6 +405,13 @@ if __name__ == '__main__':
         nargs='*',
         help='album titles separated by spaces',
     )
+    parser.add_argument(
+        '-w',
+        '--workers',
+        type=int,
+        default=4,
+        help='number of photos to download at once (default: 4)',
+    )
     args = parser.parse_args()
 
     api = login()
@@ -246,12 +420,8 @@ if __name__ == '__main__':
     albums = [a for a in args.albums if 'icloud.py' not in a]
 
     for i, album in enumerate(albums):
-        # Kludge: If the title is a month/year combo, use a simplified path.
-        album_folder = album
-        try:
-            album_folder = parse(album).strftime('%Y-%m')
-        except:
-            pass
-        download_path = Path('data') / album_folder
+        download_path = Path('data') / get_album_folder(album)
         download_path.mkdir(parents=True, exist_ok=True)
-        download_album(download_path, api.photos.albums[album])
+        download_album(
+            download_path, api.photos.albums[album], max_workers=args.workers
+        )
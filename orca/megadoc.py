@@ -1,26 +1,121 @@
 """TODO: File description."""
-import json
 import logging
+import os
+import re
+import shutil
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from functools import partial
 from pathlib import Path
-from typing import Iterable, Tuple
+from typing import IO, Iterable, Iterator, Tuple
+from xml.sax.saxutils import escape
+from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile, ZipInfo
 
-from docx import Document
+import orjson
+from unidecode import unidecode
+
+try:
+    # simdjson only builds Python objects for the parts of a document that we
+    # actually look at, so it never has to allocate all of the bounding boxes
+    # and confidence scores that make up most of each OCR result.
+    from simdjson import Parser as JSONParser
+except ImportError:
+    JSONParser = None
 
 log = logging.getLogger(__name__)
 
+# A .docx file is just a zip of XML files. Our megadocs only ever use three
+# kinds of paragraph (two levels of heading, plus plain text) and page breaks,
+# so instead of going through python-docx and lxml we can write the XML
+# ourselves. Everything apart from the document body is fixed boilerplate.
+_W = 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'
+_R = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+_PKG = 'http://schemas.openxmlformats.org/package/2006'
+
+DOCX_CONTENT_TYPES = f"""<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Types xmlns="{_PKG}/content-types">
+<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>
+<Default Extension="xml" ContentType="application/xml"/>
+<Override PartName="/word/document.xml" ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>
+<Override PartName="/word/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.styles+xml"/>
+</Types>"""
+
+DOCX_RELS = f"""<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="{_PKG}/relationships">
+<Relationship Id="rId1" Type="{_R}/officeDocument" Target="word/document.xml"/>
+</Relationships>"""
+
+DOCX_DOCUMENT_RELS = f"""<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="{_PKG}/relationships">
+<Relationship Id="rId1" Type="{_R}/styles" Target="styles.xml"/>
+</Relationships>"""
+
+DOCX_STYLES = f"""<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<w:styles xmlns:w="{_W}">
+<w:docDefaults>
+<w:rPrDefault><w:rPr><w:sz w:val="22"/><w:szCs w:val="22"/></w:rPr></w:rPrDefault>
+<w:pPrDefault><w:pPr><w:spacing w:after="200" w:line="276" w:lineRule="auto"/></w:pPr></w:pPrDefault>
+</w:docDefaults>
+<w:style w:type="paragraph" w:default="1" w:styleId="Normal">
+<w:name w:val="Normal"/><w:qFormat/>
+</w:style>
+<w:style w:type="paragraph" w:styleId="Heading1">
+<w:name w:val="heading 1"/><w:basedOn w:val="Normal"/><w:next w:val="Normal"/><w:qFormat/>
+<w:pPr><w:keepNext/><w:spacing w:before="480" w:after="0"/><w:outlineLvl w:val="0"/></w:pPr>
+<w:rPr><w:b/><w:bCs/><w:color w:val="365F91"/><w:sz w:val="28"/><w:szCs w:val="28"/></w:rPr>
+</w:style>
+<w:style w:type="paragraph" w:styleId="Heading2">
+<w:name w:val="heading 2"/><w:basedOn w:val="Normal"/><w:next w:val="Normal"/><w:qFormat/>
+<w:pPr><w:keepNext/><w:spacing w:before="200" w:after="0"/><w:outlineLvl w:val="1"/></w:pPr>
+<w:rPr><w:b/><w:bCs/><w:color w:val="4F81BD"/><w:sz w:val="26"/><w:szCs w:val="26"/></w:rPr>
+</w:style>
+</w:styles>"""
+
+DOCX_BODY_START = f"""<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<w:document xmlns:w="{_W}" xmlns:r="{_R}"><w:body>""".encode()
+
+DOCX_BODY_END = (
+    b'<w:sectPr><w:pgSz w:w="12240" w:h="15840"/>'
+    b'<w:pgMar w:top="1440" w:right="1800" w:bottom="1440" w:left="1800"'
+    b' w:header="720" w:footer="720" w:gutter="0"/></w:sectPr>'
+    b'</w:body></w:document>'
+)
+
+# Every page has the same structure, so we only need to fill in the blanks:
+# the name and timestamp headings, then one paragraph per block of text, then
+# a page break.
+DOCX_PAGE_START = (
+    b'<w:p><w:pPr><w:pStyle w:val="Heading1"/></w:pPr>'
+    b'<w:r><w:t xml:space="preserve">%s</w:t></w:r></w:p>'
+    b'<w:p><w:pPr><w:pStyle w:val="Heading2"/></w:pPr>'
+    b'<w:r><w:t xml:space="preserve">%s</w:t></w:r></w:p>'
+)
+DOCX_PAGE_END = b'<w:p><w:r><w:br w:type="page"/></w:r></w:p>'
+DOCX_PARAGRAPH_START = b'<w:p><w:r>'
+DOCX_PARAGRAPH_END = b'</w:r></w:p>'
+DOCX_TEXT = b'<w:t xml:space="preserve">%s</w:t>'
+DOCX_LINE_BREAK = b'<w:br/>'
+
+# XML 1.0 doesn't allow most control characters, even escaped, and a single
+# stray one from OCR would leave Word unable to open the file.
+_XML_ILLEGAL = dict.fromkeys(c for c in range(32) if c not in (9, 10, 13))
+
+_DIGITS = re.compile(r'(\d+)')
+
 
 def get_headings(file_path: str | Path) -> Tuple[str, str]:
     """TODO: Description."""
-    from dateutil.parser import parse
-
     # Try to use the format from icloud.py first. If that doesn't work, just
     # come back with the original filename so we at least have something.
+    # The format is fixed, so there's no need for dateutil's guesswork here.
     file_path = Path(file_path)
     try:
         parts = file_path.stem.split('_')
 
         date, time = parts[:2]
-        timestamp = parse(f"{date} {time.replace('-', ':')}")
+        timestamp = datetime.strptime(f"{date}_{time}", '%Y-%m-%d_%H-%M-%S')
         timestamp = timestamp.strftime('%B %d, %Y at %I:%M %p')
 
         name = '_'.join(parts[2:])
@@ -31,28 +126,213 @@ def get_headings(file_path: str | Path) -> Tuple[str, str]:
         return file_path.name, '[No timestamp.]'
 
 
+def to_ascii(text: str) -> str:
+    """Transliterate OCR text to plain ASCII with `unidecode`."""
+    # Most OCR output is plain ASCII already, and checking that is far cheaper
+    # than sending every line through unidecode.
+    if text.isascii():
+        return text
+    return unidecode(text)
+
+
+def natural_key(name: str) -> list:
+    """Sort key for the JSON files: the same order `vision.py` sends images in."""
+    # This is a copy of `vision.natural_key` rather than an import, since each
+    # module is run on its own as a script. Keep the two in step.
+    parts = _DIGITS.split(name)
+    parts[1::2] = map(int, parts[1::2])
+    return parts
+
+
 def zip_files(file_paths: Iterable[str | Path], out_path: str | Path) -> None:
     """TODO: Description."""
-    from zipfile import ZipFile
-
+    # The .docx files are zip archives themselves, so there's nothing to gain
+    # from compressing them again. Just store them, and copy each one in with
+    # a big buffer rather than in lots of little reads.
     log.info('Zipping files into %s...' % out_path)
-    with ZipFile(Path(out_path).as_posix(), 'w') as zip:
+    with ZipFile(Path(out_path).as_posix(), 'w', compression=ZIP_STORED) as zip:
         for file in [Path(p) for p in file_paths]:
             if file.exists() and file.is_file():
-                zip.write(file, file.name)
+                info = ZipInfo.from_file(file, file.name)
+                with file.open('rb') as src, zip.open(info, 'w') as dst:
+                    shutil.copyfileobj(src, dst, length=1024 * 1024)
     log.info('Done!')
 
 
-def build_doc(data_path: str | Path, chunk_size: int = 5000) -> Path:
-    """TODO: Description."""
-    from natsort import natsorted
-    from unidecode import unidecode
+def read_ahead(
+    file_paths: Iterable[str | Path], max_workers: int = 4, depth: int = 32
+) -> Iterator[bytes]:
+    """
+    Read files on background threads, yielding their contents in order.
+
+    Parameters:
+        file_paths (iterable of str or Path): Files to read.
+        max_workers (int): Number of threads doing the reading.
+        depth (int): How many files to read ahead of the caller.
+
+    Returns:
+        iterator of bytes: Contents of each file, in the order given.
+    """
+
+    def read(file_path: str | Path) -> bytes:
+        with open(file_path, 'rb') as f:
+            return f.read()
+
+    # Keep a handful of reads going while the caller works on what's already
+    # come back, without ever holding more than `depth` files in memory.
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        for file_path in file_paths:
+            pending.append(executor.submit(read, file_path))
+            if len(pending) >= depth:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def xml_text(text: str) -> bytes:
+    """Escape text for use inside a `<w:t>` element."""
+    return escape(text.translate(_XML_ILLEGAL)).encode()
+
+
+def paragraph_xml(lines: Iterable[str]) -> bytes:
+    """Return the XML for a plain paragraph, with a line break between lines."""
+    runs = DOCX_LINE_BREAK.join(DOCX_TEXT % xml_text(line) for line in lines)
+    return DOCX_PARAGRAPH_START + runs + DOCX_PARAGRAPH_END
+
+
+def iter_paragraphs(data: dict) -> Iterator[list[str]]:
+    """
+    Get the text out of an Azure OCR result, one paragraph at a time.
+
+    Parameters:
+        data (dict): OCR results for a single image.
+
+    Returns:
+        iterator of list of str: Lines of ASCII text in each paragraph.
+    """
+    # Different Azure models return data in different formats. We can tell
+    # which one was used by the way key used to store the result.
+    # ... Computer Vision
+    if 'readResult' in data:
+        block_key = 'blocks' if 'blocks' in data['readResult'] else 'pages'
+        for block in data['readResult'][block_key]:
+            lines = []
+            for line in block['lines']:
+                text_key = 'text' if 'text' in line else 'content'
+                lines.append(to_ascii(line[text_key]))
+            yield lines
+
+    # ... Document Intelligence
+    elif 'analyzeResult' in data:
+        try:
+            for p in data['analyzeResult']['paragraphs']:
+                yield to_ascii(p['content']).split('\n')
+        except KeyError:
+            yield ['[No text recovered.]']
+
+    # ... something went wrong; OCR errored out somehow.
+    else:
+        yield ['[No text recovered.]']
+
+
+@contextmanager
+def open_docx(doc_file: str | Path) -> Iterator[IO[bytes]]:
+    """Create a .docx file and return a stream to write the document body to."""
+    # Build the file under a temporary name and only move it into place once
+    # it's finished. A zip file closes cleanly even if we bail out halfway, so
+    # otherwise a failed chunk would look done but Word wouldn't open it.
+    doc_file = Path(doc_file)
+    part_file = doc_file.with_name(doc_file.name + '.part')
+    try:
+        # Go easy on the compression. It's where most of the time goes, and we
+        # don't gain much from squeezing the files any harder.
+        with ZipFile(
+            part_file.as_posix(), 'w', compression=ZIP_DEFLATED, compresslevel=1
+        ) as zip:
+            zip.writestr('[Content_Types].xml', DOCX_CONTENT_TYPES)
+            zip.writestr('_rels/.rels', DOCX_RELS)
+            zip.writestr('word/_rels/document.xml.rels', DOCX_DOCUMENT_RELS)
+            zip.writestr('word/styles.xml', DOCX_STYLES)
+            with zip.open('word/document.xml', 'w', force_zip64=True) as body:
+                yield body
+    except BaseException:
+        part_file.unlink(missing_ok=True)
+        raise
+    os.replace(part_file, doc_file)
+
+
+def build_chunk(
+    json_files: list[str], doc_file: str | Path, start: int = 0, file_count: int = 0
+) -> Path:
+    """
+    Build a single megadoc chunk out of a list of JSON files.
+
+    Parameters:
+        json_files (list of str): Paths to the JSON files in this chunk.
+        doc_file (str or Path): Path to save the finished .docx file to.
+        start (int): Position of the first file in the whole megadoc, for logging.
+        file_count (int): Number of files in the whole megadoc, for logging.
+
+    Returns:
+        Path: Path to the saved .docx file.
+    """
+    doc_file = Path(doc_file)
+    file_count = file_count or len(json_files)
+
+    # Write the XML for each page into a buffer as we go, and send each page
+    # out to the file as soon as it's finished, so we only ever hold one page
+    # in memory instead of the whole document.
+    page = bytearray()
+    emit = page.extend
+    parse = JSONParser().parse if JSONParser else orjson.loads
+
+    log.info('Building %s...' % doc_file)
+    with open_docx(doc_file) as body:
+        body.write(DOCX_BODY_START)
+
+        # Most of these files are small, so we'd spend much of our time waiting
+        # on the disk if we read them one at a time.
+        raw_files = read_ahead(json_files)
+        for i, (json_file, raw) in enumerate(zip(json_files, raw_files)):
+            log.info('%s (%d/%d)' % (json_file, i + start + 1, file_count))
+            data = parse(raw)
+
+            # Get heading from filename.
+            name, timestamp = get_headings(json_file)
+            emit(DOCX_PAGE_START % (xml_text(name), xml_text(timestamp)))
+
+            for lines in iter_paragraphs(data):
+                emit(paragraph_xml(lines))
 
+            # simdjson won't parse the next file while this one is still alive.
+            del data
+
+            emit(DOCX_PAGE_END)
+            body.write(page)
+            page.clear()
+
+        log.info('Saving %s...' % doc_file)
+        body.write(DOCX_BODY_END)
+
+    return doc_file
+
+
+def build_doc(
+    data_path: str | Path, chunk_size: int = 5000, max_workers: int | None = None
+) -> Path:
+    """TODO: Description."""
     data_path = Path(data_path)
     out_path = data_path / 'megadoc'
     out_path.mkdir(parents=True, exist_ok=True)
 
-    json_files = natsorted(list(data_path.glob('*.json')))
+    # List the JSON files in a single pass over the directory. Unlike glob(),
+    # scandir() doesn't need to stat each entry, and we can hang on to the
+    # plain string paths instead of building a Path for every file.
+    with os.scandir(data_path) as entries:
+        json_files = [e for e in entries if e.name.endswith('.json')]
+    json_files.sort(key=lambda e: natural_key(e.name))
+    json_files = [e.path for e in json_files]
 
     # Word docs can only realistically handle so much stuff at once before we
     # start hitting RAM limits. We can manage this by breaking each megadoc
@@ -62,58 +342,38 @@ def build_doc(data_path: str | Path, chunk_size: int = 5000) -> Path:
     if file_count % chunk_size != 0:
         chunk_total += 1
 
-    chunk_files = []
+    jobs = []
     for chunk in range(chunk_total):
         start = chunk * chunk_size
         end = (chunk + 1) * chunk_size
 
-        doc = Document()
         filename = (
             f"{data_path.parent.name}_{(chunk + 1):02d}of{(chunk_total):02d}.docx"
         )
         doc_file = out_path / filename
-
-        log.info('Building %s...' % doc_file)
-        for i, json_file in enumerate(json_files[start:end]):
-            log.info('%s (%d/%d)' % (json_file, i + start + 1, file_count))
-            with json_file.open() as f:
-                data = json.load(f)
-
-            # Get heading from filename.
-            name, timestamp = get_headings(json_file)
-            doc.add_heading(name, level=1)
-            doc.add_heading(timestamp, level=2)
-
-            # Different Azure models return data in different formats. We can
-            # tell which one was used by the way key used to store the result.
-            # TODO: Break this out into separate function definition(s).
-            # ... Computer Vision
-            if 'readResult' in data:
-                block_key = 'blocks' if 'blocks' in data['readResult'] else 'pages'
-                for block in data['readResult'][block_key]:
-                    lines = []
-                    for line in block['lines']:
-                        text_key = 'text' if 'text' in line else 'content'
-                        lines.append(unidecode(line[text_key]))
-                    doc.add_paragraph('\n'.join(lines))
-
-            # ... Document Intelligence
-            elif 'analyzeResult' in data:
-                try:
-                    for p in data['analyzeResult']['paragraphs']:
-                        doc.add_paragraph(unidecode(p['content']))
-                except KeyError:
-                    doc.add_paragraph('[No text recovered.]')
-
-            # ... something went wrong; OCR errored out somehow.
-            else:
-                doc.add_paragraph('[No text recovered.]')
-
-            doc.add_page_break()
-
-        log.info('Saving %s...' % doc_file)
-        doc.save(doc_file.as_posix())
-        chunk_files.append(doc_file)
+        jobs.append((json_files[start:end], doc_file, start, file_count))
+
+    # The chunks don't share anything, so we can build them all at once on
+    # separate processes. There's no point starting more processes than there
+    # are chunks, though, and most albums fit in a single chunk anyway, in
+    # which case we may as well just build it here.
+    if max_workers is None:
+        max_workers = min(os.cpu_count() or 1, chunk_total)
+
+    if max_workers <= 1 or chunk_total <= 1:
+        chunk_files = [build_chunk(*job) for job in jobs]
+    else:
+        # Pass along our log level so we still hear from the workers.
+        init_logging = partial(
+            logging.basicConfig,
+            level=logging.getLogger().getEffectiveLevel(),
+            format='%(asctime)s - %(levelname)s - %(message)s',
+        )
+        with ProcessPoolExecutor(
+            max_workers=max_workers, initializer=init_logging
+        ) as executor:
+            futures = [executor.submit(build_chunk, *job) for job in jobs]
+            chunk_files = [future.result() for future in futures]
 
     zip_files(chunk_files, out_path / f"{data_path.parent.name}_{data_path.name}.zip")
     log.info('Done!')
@@ -17,6 +17,9 @@ Functions:
     analyze_image(img_file: Path, img_type: str) -> dict:
         Analyzes an image file for text content using Azure Computer Vision.
         Returns a dictionary containing the OCR results.
+    analyze_images(in_path: Path, out_path: Path):
+        Analyzes every image in a directory, several at a time, and saves the
+        OCR results for each one as JSON.
 
 Usage:
     When used as a standalone script:
@@ -25,55 +28,191 @@ Usage:
     When imported as a module:
         - Call the `analyze_image` function with an image file path.
 """
-import json
+import functools
 import logging
 import os
+import random
+import re
+import sqlite3
+import threading
 import time
+from contextlib import closing
 from pathlib import Path
+from typing import Tuple
 
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
 
 log = logging.getLogger(__name__)
 
-
-def get_img_type(file_path: str | Path) -> str:
+# Share one session between requests so that connections to Azure are kept
+# alive, instead of paying for a new TCP/TLS handshake on every image. Leave
+# retries to us, since we know which failures are worth another try.
+POOL_SIZE = 16
+_SESSION = requests.Session()
+_SESSION.mount(
+    'https://',
+    HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=0),
+)
+
+# Response codes worth retrying. Everything else is either a success or a
+# problem with the request itself, which won't fix itself on a second try.
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Longest we'll wait when Azure gives us a `Retry-After`. Azure's own hint is
+# what gets us out of being throttled, so it isn't held to `max_delay`; this is
+# only here so that a bogus header can't stall a worker indefinitely.
+MAX_RETRY_AFTER = 600.0
+
+# Sidecar database in each output directory recording which images are done.
+DONE_DB = 'processed.db'
+
+# Runs of digits in a file name, so that they can be compared as numbers.
+_DIGITS = re.compile(r'(\d+)')
+
+# Image types Azure will accept, by file extension.
+IMG_TYPES = {
+    '.bmp': 'bmp',
+    '.gif': 'gif',
+    '.heic': 'heic',
+    '.ico': 'ico',
+    '.jpg': 'jpeg',
+    '.jpeg': 'jpeg',
+    '.mpo': 'mpo',
+    '.png': 'png',
+    '.tif': 'tiff',
+    '.tiff': 'tiff',
+    '.webp': 'webp',
+}
+
+
+def get_img_type(file_path: str | Path, check_file: bool = True) -> str:
     """
     Verify file exists, is a file, and is a supported image type.
 
     Parameters:
         file_path (str or Path): Path to the file.
+        check_file (bool, optional): Whether to check that the file exists.
+            Callers that got the path from a directory listing can skip this.
+            Defaults to True.
 
     Returns:
         str: Image content-type string.
     """
     file_path = Path(file_path)
-    if not file_path.exists() or not file_path.is_file():
+    if check_file and (not file_path.exists() or not file_path.is_file()):
         return
-    ext = file_path.suffix.lower()
-
-    if ext == '.bmp':
-        return 'bmp'
-    if ext == '.gif':
-        return 'gif'
-    if ext == '.heic':
-        return 'heic'
-    if ext == '.ico':
-        return 'ico'
-    if ext == '.jpg' or ext == '.jpeg':
-        return 'jpeg'
-    if ext == '.mpo':
-        return 'mpo'
-    if ext == '.png':
-        return 'png'
-    if ext == '.tif' or ext == '.tiff':
-        return 'tiff'
-    if ext == '.webp':
-        return 'webp'
-    return
+    return IMG_TYPES.get(file_path.suffix.lower())
+
+
+def natural_key(name: str) -> list:
+    """Sort key that puts e.g. `IMG_2` before `IMG_10`."""
+    # `megadoc.py` has its own copy of this, so it can run as a script without
+    # importing us; change both together.
+    # Splitting on a capturing group always gives text at the even positions
+    # and digits at the odd ones, so two keys never compare str against int.
+    parts = _DIGITS.split(name)
+    parts[1::2] = map(int, parts[1::2])
+    return parts
+
+
+@functools.cache
+def get_request_config() -> Tuple[str, dict, dict]:
+    """
+    Build the request URI, parameters and headers for Azure Computer Vision.
+
+    Returns:
+        tuple: Request URI, query parameters, and headers.
+
+    These come from environment variables that don't change while we're
+    running, so they're only read the first time this is called. Make sure
+    anything like `load_dotenv()` has happened before then.
+    """
+    # Build request headers. See Azure Computer Vision docs for details.
+    uri = os.environ['_ORCA_VISION_ENDPOINT'] + '/computervision/imageanalysis:analyze'
+    params = {
+        'api-version': os.environ['_ORCA_VISION_API_VERSION'],
+        'features': 'read',
+    }
+    headers = {
+        'Content-Type': 'application/octet-stream',
+        'Ocp-Apim-Subscription-Key': os.environ['_ORCA_VISION_KEY'],
+    }
+    return uri, params, headers
+
+
+class RateLimiter:
+    """
+    Space out calls so there are no more than `rate` of them every `period`.
+
+    Parameters:
+        rate (float): Number of calls allowed per period.
+        period (float): Length of the period in seconds.
+
+    Call `wait()` before each request. It's safe to share one limiter between
+    threads; each caller is given the next free slot and sleeps until then.
+    """
+
+    def __init__(self, rate: float, period: float = 1.0):
+        self.interval = period / rate
+        self.next_slot = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def get_retry_delay(
+    response: requests.Response | None,
+    attempt: int,
+    retry_delay: float = 5.0,
+    max_delay: float = 30.0,
+) -> float:
+    """
+    Work out how long to wait before retrying a failed request.
+
+    Parameters:
+        response (Response or None): The failed response from Azure, or None if
+            the request didn't get a response at all.
+        attempt (int): Number of attempts already retried (starting at 0).
+        retry_delay (float): Seconds to wait before the first retry.
+        max_delay (float): Upper limit on the backoff between retries.
+
+    Returns:
+        float: Seconds to wait.
+
+    If Azure tells us how long to back off (it does this via the `Retry-After`
+    header when we get throttled with a 429), we go with that, even if it's
+    longer than `max_delay`: retrying any sooner would only get us throttled
+    again. Otherwise the delay doubles with each attempt, with a bit of random
+    jitter added so that parallel requests don't all come back at the same
+    moment.
+    """
+    try:
+        retry_after = float(response.headers['Retry-After'])
+        return min(max(retry_after, 0.0), MAX_RETRY_AFTER)
+    except (AttributeError, KeyError, ValueError):
+        pass
+    delay = retry_delay * 2**attempt
+    return min(delay + random.uniform(0, delay / 10), max_delay)
 
 
 def analyze_image(
-    img_file: str | Path, max_retries: int = 0, retry_delay: float = 5.0
+    img_file: str | Path,
+    max_retries: int = 0,
+    retry_delay: float = 5.0,
+    max_delay: float = 30.0,
+    rate_limiter: RateLimiter | None = None,
+    timeout: float = 120.0,
+    *,
+    convert_heic: bool | None = None,
+    session: requests.Session | None = None,
 ) -> dict:
     """
     Send image file to Azure Computer Vision for OCR.
@@ -81,11 +220,29 @@ def analyze_image(
     Parameters:
         img_file (str or Path): Path to the image file.
         max_retries (int): Retries to attempt after failed request.
-        retry_delay (float): Seconds to wait between retries.
+        retry_delay (float): Seconds to wait before the first retry. The wait
+            doubles after each failed attempt.
+        max_delay (float): Upper limit on the backoff between retries. A wait
+            asked for by Azure with `Retry-After` can go past this.
+        rate_limiter (RateLimiter, optional): Limiter to wait on before each
+            request, so that parallel calls stay under the API's rate limit.
+        timeout (float): Seconds to wait on Azure before giving up on a request.
+        convert_heic (bool, optional): Whether to convert .HEIC images to .JPG
+            before sending them. Defaults to converting them unless
+            `_ORCA_SKIP_HEIC_CONVERT=1` is set.
+        session (requests.Session, optional): Session to send the request
+            with. Defaults to the one shared by the whole module.
 
     Returns:
         dict: Image analysis results.
 
+    Raises:
+        requests.RequestException: If Azure couldn't be reached at all, even
+            after retrying.
+        requests.HTTPError: If Azure didn't return a result, for example if
+            we were still being throttled after the last retry. The response
+            is attached, so its status code and error message can be checked.
+
     API reference: https://eastus.dev.cognitive.microsoft.com/docs/services/unified-vision-apis-public-preview-2023-04-01-preview/operations/61d65934cd35050c20f73ab6
     """
     img_file = Path(img_file)
@@ -96,57 +253,81 @@ def analyze_image(
     # .HEIC files need to be converted before they get sent to Azure. Doing this
     # at download would save time if we ran this a lot, but .HEIC is a very
     # efficient format, and leaving it behind would take up more disk space.
-    if img_type == 'heic':
-        import pyheif
-        from PIL import Image
-
-        log.debug('Converting %s to .PNG...' % img_file)
-        heif = pyheif.read(img_file.as_posix())
-        img = Image.frombytes(
-            heif.mode,
-            heif.size,
-            heif.data,
-            'raw',
-            heif.mode,
-            heif.stride,
-        )
-        img_file = img_file.with_suffix('.png')
-        img.save(img_file.as_posix())
-
-    with img_file.open('rb') as f:
-        image = f.read()
+    # Newer versions of the API can take .HEIC as-is, though, in which case we
+    # can set `_ORCA_SKIP_HEIC_CONVERT=1` and skip the conversion altogether.
+    if convert_heic is None:
+        convert_heic = os.environ.get('_ORCA_SKIP_HEIC_CONVERT') != '1'
+    convert_heic = convert_heic and img_type == 'heic'
 
-    # Build request headers. See Azure Computer Vision docs for details.
-    uri = os.environ['_ORCA_VISION_ENDPOINT'] + '/computervision/imageanalysis:analyze'
-    params = {
-        'api-version': os.environ['_ORCA_VISION_API_VERSION'],
-        'features': 'read',
-    }
-    headers = {
-        'Content-Type': 'application/octet-stream',
-        'Ocp-Apim-Subscription-Key': os.environ['_ORCA_VISION_KEY'],
-    }
+    uri, params, headers = get_request_config()
+    session = session or _SESSION
 
-    attempt = 0
-    while attempt == 0 or attempt < max_retries:
-        response = requests.post(uri, headers=headers, params=params, data=image)
-        status = response.status_code
-        if attempt < max_retries and status != 200:
-            log.error('Failed with code %d.' % status)
-            if attempt < max_retries:
+    jpg_file = None
+    try:
+        if convert_heic:
+            from PIL import Image
+            from pillow_heif import register_heif_opener
+
+            # Let PIL decode the HEIC file itself, straight into the image,
+            # rather than copying the pixels out through pyheif first.
+            register_heif_opener()
+            log.debug('Converting %s to .JPG...' % img_file)
+            with Image.open(img_file.as_posix()) as img:
+                if img.mode not in ('RGB', 'L'):
+                    img = img.convert('RGB')
+                # Keep track of the .JPG from before we start writing it, so that
+                # it gets cleaned up even if the conversion only gets partway.
+                jpg_file = img_file = img_file.with_suffix('.jpg')
+                img.save(img_file.as_posix(), 'JPEG', quality=92, optimize=False)
+
+        # We stream the image straight from disk rather than reading it all into
+        # memory first, so set the length ourselves to avoid a chunked upload.
+        headers = {**headers, 'Content-Length': str(img_file.stat().st_size)}
+
+        with img_file.open('rb') as image:
+            for attempt in range(max_retries + 1):
+                image.seek(0)
+                if rate_limiter:
+                    rate_limiter.wait()
+
+                # Only retry errors that might go away on their own: throttling,
+                # server-side trouble, or the connection dropping. Anything else
+                # (a bad key, an image Azure won't take) will just fail again.
+                try:
+                    response = session.post(
+                        uri, headers=headers, params=params, data=image, timeout=timeout
+                    )
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    if attempt == max_retries:
+                        raise
+                    response = None
+                    log.error('Failed with %s.' % type(e).__name__)
+                else:
+                    status = response.status_code
+                    if status not in RETRY_STATUSES or attempt == max_retries:
+                        break
+                    log.error('Failed with code %d.' % status)
+
+                delay = get_retry_delay(response, attempt, retry_delay, max_delay)
                 log.info(
                     'Retrying in %d seconds (%d/%d)...'
-                    % (retry_delay, attempt + 1, max_retries)
+                    % (delay, attempt + 1, max_retries)
                 )
-                attempt += 1
-                time.sleep(retry_delay)
-        else:
-            break
-
-    # Delete converted version if we made one.
-    if img_type == 'heic':
-        log.debug('Deleting %s...' % img_file)
-        img_file.unlink()
+                time.sleep(delay)
+
+    finally:
+        # Delete converted version if we made one.
+        if jpg_file:
+            log.debug('Deleting %s...' % jpg_file)
+            jpg_file.unlink(missing_ok=True)
+
+    # Don't pass an error message off as a result, or it'd get saved and the
+    # image would never be tried again.
+    if status != 200:
+        log.error('Failed with code %d (%s).' % (status, img_file.name))
+        raise requests.HTTPError(
+            '%d error for %s' % (status, img_file.name), response=response
+        )
 
     try:
         return response.json()
@@ -154,32 +335,192 @@ def analyze_image(
         return {}
 
 
+def open_done_db(out_path: str | Path) -> sqlite3.Connection:
+    """
+    Open the database of processed images in an output directory.
+
+    Parameters:
+        out_path (str or Path): Directory the JSON results are saved to.
+
+    Returns:
+        sqlite3.Connection: Connection with a `done` table keyed on image stem.
+
+    The `status` of each image is the HTTP status code Azure last gave for it.
+    Only images with a 200 have been processed; the rest need another go.
+    """
+    conn = sqlite3.connect(Path(out_path) / DONE_DB)
+    # With a write-ahead log, committing after each image doesn't have to wait
+    # on an fsync, and a crash still can't leave the database half-written.
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute(
+        'CREATE TABLE IF NOT EXISTS done (stem TEXT PRIMARY KEY, status INT, ts REAL)'
+    )
+    return conn
+
+
 def analyze_images(
     in_path: str | Path,
     out_path: str | Path,
     max_retries: int = 0,
     retry_delay: float = 5.0,
+    max_workers: int = 8,
+    max_rate: float | None = 9.0,
+    max_delay: float = 30.0,
 ):
-    """TODO: Description."""
+    """
+    Send every image in a directory to Azure Computer Vision and save results.
+
+    Parameters:
+        in_path (str or Path): Directory containing the image files.
+        out_path (str or Path): Directory to save the JSON results to.
+        max_retries (int): Retries to attempt after failed request.
+        retry_delay (float): Seconds to wait before the first retry. The wait
+            doubles after each failed attempt.
+        max_workers (int): Number of requests to keep in flight at once.
+        max_rate (float, optional): Most requests to send per second. Set this
+            just under the transactions-per-second quota for the Azure pricing
+            tier, or to None for no limit.
+        max_delay (float): Upper limit on the backoff between retries. A wait
+            asked for by Azure with `Retry-After` can go past this.
+
+    Images that have already been processed are skipped, so an interrupted
+    run can be picked up again where it left off. These are recorded in a
+    small SQLite database in `out_path` (see `open_done_db`), which is filled
+    in from any JSON files already there the first time it's used. Images
+    Azure returned an error for are left without a JSON file and tried again
+    on the next run, as is any image whose JSON file has since been deleted.
+
+    Requests are spread across a pool of worker threads: the time spent on
+    each image is almost all waiting on Azure, so keeping several in flight at
+    once cuts the wall time roughly in proportion, up to the API's rate limit.
+    Requests are spaced out to stay under that limit rather than running into
+    it and having to back off.
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
     in_path = Path(in_path)
     out_path = Path(out_path)
     out_path.mkdir(parents=True, exist_ok=True)
 
+    # Fail now if the Azure settings are missing, rather than letting every
+    # image fail the same way and carrying on as though they were bad images.
+    get_request_config()
+
+    # Make sure the shared session can hold a connection open for each worker.
+    # Otherwise any connections past the pool size get thrown away after each
+    # request and we're back to a new handshake every time.
+    if max_workers > POOL_SIZE:
+        adapter = HTTPAdapter(
+            pool_connections=max_workers, pool_maxsize=max_workers, max_retries=0
+        )
+        _SESSION.mount('https://', adapter)
+
+    rate_limiter = RateLimiter(max_rate) if max_rate else None
+
     log.info('Sending %s to Azure Vision...' % in_path)
-    img_files = natsorted([f for f in in_path.iterdir() if get_img_type(f)])
+    # The directory listing already tells us which entries are files, so there's
+    # no need to go back and stat each one.
+    with os.scandir(in_path) as entries:
+        img_files = [
+            Path(e.path)
+            for e in entries
+            if e.is_file() and get_img_type(e.name, check_file=False)
+        ]
+    img_files.sort(key=lambda p: natural_key(p.name))
     count = len(img_files)
-    for i, img_file in enumerate(img_files):
-        json_file = out_path / f"{img_file.stem}.json"
 
-        # Skip files we already have data for.
-        if json_file.exists():
-            log.info('Skipping %s (%d/%d), processed.' % (json_file, i + 1, count))
-            continue
+    # Likewise, find out what's already been processed in one go rather than
+    # checking for each image's JSON file separately. The database says which
+    # images worked, but it's the JSON files that go into the megadoc, so only
+    # count an image as done if its file is still there too.
+    with os.scandir(out_path) as entries:
+        saved = {e.name[:-5] for e in entries if e.name.endswith('.json')}
+
+    with closing(open_done_db(out_path)) as conn, ThreadPoolExecutor(
+        max_workers=max_workers
+    ) as executor:
+        # Images that failed are kept in the database too, along with the code
+        # Azure gave us, but they aren't done: try them again this time.
+        done = {
+            row[0]
+            for row in conn.execute('SELECT stem FROM done WHERE status = 200')
+            if row[0] in saved
+        }
+
+        # If the database is new, seed it from whatever results are already in
+        # the output directory.
+        if not conn.execute('SELECT 1 FROM done LIMIT 1').fetchone():
+            done = saved
+            now = time.time()
+            conn.executemany(
+                'INSERT OR IGNORE INTO done VALUES (?, ?, ?)',
+                ((stem, 200, now) for stem in done),
+            )
+            conn.commit()
+
+        futures = {}
+        for i, img_file in enumerate(img_files):
+            json_file = out_path / f"{img_file.stem}.json"
+
+            # Skip files we already have data for.
+            if img_file.stem in done:
+                log.info('Skipping %s (%d/%d), processed.' % (json_file, i + 1, count))
+                continue
+
+            future = executor.submit(
+                analyze_image,
+                img_file,
+                max_retries,
+                retry_delay,
+                max_delay,
+                rate_limiter=rate_limiter,
+            )
+            futures[future] = (i, json_file)
+
+        try:
+            for future in as_completed(futures):
+                i, json_file = futures[future]
+                try:
+                    data = future.result()
+                except requests.HTTPError as e:
+                    # Note down what went wrong, but don't write out a JSON file
+                    # or mark the image done, so it gets picked up next time.
+                    log.error(
+                        'Giving up on %s (%d/%d): %s' % (json_file, i + 1, count, e)
+                    )
+                    conn.execute(
+                        'INSERT OR REPLACE INTO done VALUES (?, ?, ?)',
+                        (json_file.stem, e.response.status_code, time.time()),
+                    )
+                    conn.commit()
+                    continue
+                except Exception as e:
+                    # One bad image (a dropped connection, a .HEIC file that
+                    # won't decode) shouldn't hold up the rest. Leave it without
+                    # a JSON file so it gets picked up next time.
+                    log.error(
+                        'Giving up on %s (%d/%d): %s' % (json_file, i + 1, count, e)
+                    )
+                    continue
+                json_file.write_bytes(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+
+                # Only mark the image done once its results are safely on disk.
+                # The connection isn't shared with the worker threads, so this
+                # stays here in the main thread.
+                conn.execute(
+                    'INSERT OR REPLACE INTO done VALUES (?, ?, ?)',
+                    (json_file.stem, 200, time.time()),
+                )
+                conn.commit()
+                log.info('%s (%d/%d)' % (json_file, i + 1, count))
 
-        log.info('%s (%d/%d)...' % (json_file, i + 1, count))
-        data = analyze_image(img_file, max_retries, retry_delay)
-        with json_file.open('w') as f:
-            json.dump(data, f, indent=4)
+        except BaseException:
+            # If we're stopping (Ctrl-C, or we can't write results), drop the
+            # images still waiting in the queue instead of sending every one of
+            # them to Azure and throwing the results away.
+            executor.shutdown(cancel_futures=True)
+            raise
 
     log.info('Done! Finished processing images in %s.' % in_path)
 
@@ -187,7 +528,6 @@ def analyze_images(
 if __name__ == '__main__':
     import argparse
     from dotenv import load_dotenv
-    from natsort import natsorted
 
     logging.basicConfig(
         level=logging.INFO,
@@ -197,6 +537,20 @@ if __name__ == '__main__':
     load_dotenv()
     parser = argparse.ArgumentParser()
     parser.add_argument('paths', nargs='+', help='List of file paths')
+    parser.add_argument(
+        '-r',
+        '--retries',
+        type=int,
+        default=3,
+        help='retries to attempt after a failed request (default: 3)',
+    )
+    parser.add_argument(
+        '-w',
+        '--workers',
+        type=int,
+        default=8,
+        help='number of requests to keep in flight at once (default: 8)',
+    )
     args = parser.parse_args()
 
     # Kludge: nohup includes the name of the file as one of the arguments (?)
@@ -206,4 +560,6 @@ if __name__ == '__main__':
 
     for in_path in [Path(p) for p in paths]:
         out_path = in_path / os.environ['_ORCA_VISION_MODEL']
-        analyze_images(in_path, out_path)
+        analyze_images(
+            in_path, out_path, max_retries=args.retries, max_workers=args.workers
+        )